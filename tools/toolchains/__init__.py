@@ -17,7 +17,7 @@ limitations under the License.
 
 import re
 import sys
-from os import stat, walk, getcwd, sep, remove
+from os import stat, walk, getcwd, sep, remove, environ
 from copy import copy
 from time import time, sleep
 from types import ListType
@@ -42,6 +42,9 @@ import fnmatch
 CPU_COUNT_MIN = 1
 CPU_COEF = 1
 
+# Present in MAKEFLAGS when running under a parallel GNU make (jobserver)
+JOBSERVER_PATTERN = re.compile(r'--jobserver-(auth|fds)=')
+
 class LazyDict(dict):
     def __init__(self):
         self.eager = {}
@@ -337,6 +340,8 @@ class mbedToolchain:
         "Cortex-M23": ["__CORTEX_M23", "ARM_MATH_ARMV8MBL", "__CMSIS_RTOS", "__MBED_CMSIS_RTOS_CM"],
         "Cortex-M33-NS": ["__CORTEX_M33", "ARM_MATH_ARMV8MML", "__DOMAIN_NS=1", "__FPU_PRESENT", "__CMSIS_RTOS", "__MBED_CMSIS_RTOS_CM"],
         "Cortex-M33": ["__CORTEX_M33", "ARM_MATH_ARMV8MML", "__FPU_PRESENT", "__CMSIS_RTOS", "__MBED_CMSIS_RTOS_CM"],
+        "Cortex-M55-NS": ["__CORTEX_M55", "ARM_MATH_ARMV8MML", "ARM_MATH_MVEF", "__DOMAIN_NS=1", "__FPU_PRESENT", "__CMSIS_RTOS", "__MBED_CMSIS_RTOS_CM"],
+        "Cortex-M55": ["__CORTEX_M55", "ARM_MATH_ARMV8MML", "ARM_MATH_MVEF", "__FPU_PRESENT", "__CMSIS_RTOS", "__MBED_CMSIS_RTOS_CM"],
     }
 
     MBED_CONFIG_FILE_NAME="mbed_config.h"
@@ -503,6 +508,25 @@ class mbedToolchain:
         event['toolchain'] = self
         return self.notify_fun(event, self.silent)
 
+    @staticmethod
+    def jobserver_available():
+        """Returns True when the tools are run from a parallel GNU make, which
+        exposes its jobserver through MAKEFLAGS"""
+        return JOBSERVER_PATTERN.search(environ.get('MAKEFLAGS', '')) is not None
+
+    def parallel_slots(self):
+        """Returns the job count (-jN) of an enclosing parallel GNU make,
+        capped to the host CPU count, or None if there is no enclosing make or
+        its job count is not known. Used instead of the host CPU count so that
+        the build does not oversubscribe the host when it runs as one of the
+        jobs of a parallel make."""
+        if not self.jobserver_available():
+            return None
+        match = re.search(r'(?:^|\s)-j\s*(\d+)', environ.get('MAKEFLAGS', ''))
+        if not match:
+            return None
+        return min(int(match.group(1)), int(cpu_count() * CPU_COEF))
+
     def get_symbols(self, for_asm=False):
         if for_asm:
             if self.asm_symbols is None:
@@ -923,7 +947,7 @@ class mbedToolchain:
                 objects.append(object)
 
         # Use queues/multiprocessing if cpu count is higher than setting
-        jobs = self.jobs if self.jobs else cpu_count()
+        jobs = self.jobs or self.parallel_slots() or cpu_count()
         if jobs > CPU_COUNT_MIN and len(queue) > jobs:
             return self.compile_queue(queue, objects)
         else:
@@ -948,7 +972,8 @@ class mbedToolchain:
 
     # Compile source files queue in parallel by creating pool of worker threads
     def compile_queue(self, queue, objects):
-        jobs_count = int(self.jobs if self.jobs else cpu_count() * CPU_COEF)
+        jobs_count = int(self.jobs or self.parallel_slots() or
+                         cpu_count() * CPU_COEF)
         p = Pool(processes=jobs_count)
 
         results = []
@@ -1059,6 +1084,10 @@ class mbedToolchain:
                     dependencies.extend(((self.CHROOT if self.CHROOT else '') +
                                          f.replace('\a', ' '))
                                         for f in filename.split(" "))
+                # The rule ends with the first line that is not continued.
+                # Anything after it are phony header targets (GCC's -MP)
+                if not line.rstrip().endswith('\\'):
+                    break
         return list(filter(None, dependencies))
 
     def is_not_supported_error(self, output):
@@ -1081,11 +1110,14 @@ class mbedToolchain:
 
     def compile_output(self, output=[]):
         _rc = output[0]
-        _stderr = output[1].decode("utf-8")
+        _stderr = output[1]
         command = output[2]
 
-        # Parse output for Warnings and Errors
-        self.parse_output(_stderr)
+        # Parse output for Warnings and Errors. Most compiles are silent, in
+        # which case there is nothing to decode or parse
+        if _stderr:
+            _stderr = _stderr.decode("utf-8")
+            self.parse_output(_stderr)
         self.debug("Return: %s"% _rc)
         for error_line in _stderr.splitlines():
             self.debug("Output: %s"% error_line)
@@ -15,19 +15,72 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import re
-from os.path import join, basename, splitext, dirname, exists
+from os import environ, getcwd
+from shutil import copyfile
+from collections import namedtuple
+from hashlib import md5
+from os.path import join, basename, splitext, dirname, exists, abspath
 from distutils.spawn import find_executable
 
 from tools.toolchains import mbedToolchain, TOOLCHAIN_PATHS
 from tools.hooks import hook_tool
+from tools.targets import cached
+
+GCCTools = namedtuple("GCCTools", "cc cppc ar objcopy cpp")
+
+@cached
+def _check_gcc_executable(tool_path):
+    """Probe for arm-none-eabi-gcc in tool_path, or on the PATH when tool_path
+    is not set or does not exist. The toolchain path does not change during a
+    build, so the probe is done once per path. See GCC.check_executable()"""
+    if not tool_path or not exists(tool_path):
+        if find_executable('arm-none-eabi-gcc'):
+            TOOLCHAIN_PATHS['GCC_ARM'] = ''
+            return True
+        else:
+            return False
+    else:
+        exec_name = GCC._resolve_tools(tool_path).cc
+        return exists(exec_name) or exists(exec_name + '.exe')
 
 class GCC(mbedToolchain):
     LINKER_EXT = '.ld'
     LIBRARY_EXT = '.a'
 
     STD_LIB_NAME = "lib%s.a"
-    DIAGNOSTIC_PATTERN = re.compile('((?P<file>[^:]+):(?P<line>\d+):)(\d+:)? (?P<severity>warning|[eE]rror|fatal error): (?P<message>.+)')
-    INDEX_PATTERN  = re.compile('(?P<col>\s*)\^')
+    DIAGNOSTIC_PATTERN = re.compile(r'^(?P<file>(?:[A-Za-z]:)?[^:\r\n]+):(?P<line>\d+):(?P<col>\d+)?:?[ \t]*(?P<severity>warning|[eE]rror|fatal error):[ \t]*(?P<message>[^\r\n]+)', re.MULTILINE)
+
+    # Core name -> (GCC cpu name, additional cpu flags). Cores not listed here
+    # use their lower case name and no additional flags.
+    _CORE_TABLE = {
+        "Cortex-M0+": ("cortex-m0plus", []),
+        "Cortex-M4F": ("cortex-m4", ["-mfpu=fpv4-sp-d16",
+                                     "-mfloat-abi=softfp"]),
+        "Cortex-M7F": ("cortex-m7", ["-mfpu=fpv5-sp-d16",
+                                     "-mfloat-abi=softfp"]),
+        "Cortex-M7FD": ("cortex-m7", ["-mfpu=fpv5-d16",
+                                      "-mfloat-abi=softfp"]),
+        "Cortex-M23-NS": ("cortex-m23", ["-march=armv8-m.base"]),
+        "Cortex-M23": ("cortex-m23", ["-march=armv8-m.base", "-mcmse"]),
+        "Cortex-M33-NS": ("cortex-m33", ["-march=armv8-m.main"]),
+        "Cortex-M33": ("cortex-m33", ["-march=armv8-m.main", "-mcmse"]),
+        # Helium (MVE) with single and double precision floating point
+        "Cortex-M55-NS": ("cortex-m55", ["-march=armv8.1-m.main+mve.fp+fp.dp",
+                                         "-mfpu=auto", "-mfloat-abi=softfp"]),
+        "Cortex-M55": ("cortex-m55", ["-march=armv8.1-m.main+mve.fp+fp.dp",
+                                      "-mfpu=auto", "-mfloat-abi=softfp",
+                                      "-mcmse"]),
+        "Cortex-A9": ("cortex-a9", ["-mthumb-interwork", "-marm",
+                                    "-march=armv7-a", "-mfpu=vfpv3",
+                                    "-mfloat-abi=hard",
+                                    "-mno-unaligned-access"]),
+    }
+
+    # Output extension -> objcopy output format. ELF output is a plain copy
+    _BIN_FMT = {'.bin': 'binary', '.hex': 'ihex', '.elf': None}
+
+    # Resolved tool locations, keyed on the toolchain path
+    _TOOL_CACHE = {}
 
     def __init__(self, target,  notify=None, macros=None,
                  silent=False, extra_verbose=False, build_profile=None,
@@ -48,130 +101,170 @@ class GCC(mbedToolchain):
             self.flags["common"].append("-DMBED_RTOS_SINGLE_THREAD")
             self.flags["ld"].append("--specs=nano.specs")
 
-        if target.core == "Cortex-M0+":
-            cpu = "cortex-m0plus"
-        elif target.core == "Cortex-M4F":
-            cpu = "cortex-m4"
-        elif target.core == "Cortex-M7F":
-            cpu = "cortex-m7"
-        elif target.core == "Cortex-M7FD":
-            cpu = "cortex-m7"
-        elif target.core == "Cortex-M23-NS":
-            cpu = "cortex-m23"
-        elif target.core == "Cortex-M33-NS":
-            cpu = "cortex-m33"
-        else:
-            cpu = target.core.lower()
+        # Link time optimization. Fat LTO objects keep regular object code
+        # next to the LTO bytecode, so the archives stay usable without it
+        self.lto = getattr(target, "enable_lto", False)
+        if self.lto:
+            self.flags["common"].extend(["-flto", "-ffat-lto-objects"])
+            self.flags["ld"].extend(["-flto", "-fuse-linker-plugin"])
+
+        # Precompile the configuration header. See build_pch()
+        self.enable_pch = getattr(target, "enable_pch", False)
 
+        cpu, extra = self._CORE_TABLE.get(target.core,
+                                          (target.core.lower(), []))
         self.cpu = ["-mcpu=%s" % cpu]
         if target.core.startswith("Cortex-M"):
             self.cpu.append("-mthumb")
+        self.cpu.extend(extra)
 
-        # FPU handling, M7 possibly to have double FPU
-        if target.core == "Cortex-M4F":
-            self.cpu.append("-mfpu=fpv4-sp-d16")
-            self.cpu.append("-mfloat-abi=softfp")
-        elif target.core == "Cortex-M7F":
-            self.cpu.append("-mfpu=fpv5-sp-d16")
-            self.cpu.append("-mfloat-abi=softfp")
-        elif target.core == "Cortex-M7FD":
-            self.cpu.append("-mfpu=fpv5-d16")
-            self.cpu.append("-mfloat-abi=softfp")
-
-        if target.core == "Cortex-A9":
-            self.cpu.append("-mthumb-interwork")
-            self.cpu.append("-marm")
-            self.cpu.append("-march=armv7-a")
-            self.cpu.append("-mfpu=vfpv3")
-            self.cpu.append("-mfloat-abi=hard")
-            self.cpu.append("-mno-unaligned-access")
-
-        if target.core.startswith("Cortex-M23"):
-            self.cpu.append("-march=armv8-m.base")
-        elif target.core.startswith("Cortex-M33"):
-            self.cpu.append("-march=armv8-m.main")
-
-        if target.core == "Cortex-M23" or target.core == "Cortex-M33":
-            self.cpu.append("-mcmse")
+        # Targets may opt in to the hard float ABI, where floating point
+        # arguments are passed in FPU registers instead of core registers
+        if getattr(target, "fpu_abi", "softfp") == "hard":
+            self.cpu = ["-mfloat-abi=hard" if f == "-mfloat-abi=softfp" else f
+                        for f in self.cpu]
 
         self.flags["common"] += self.cpu
 
-        main_cc = join(tool_path, "arm-none-eabi-gcc")
-        main_cppc = join(tool_path, "arm-none-eabi-g++")
-        self.asm = [main_cc] + self.flags['asm'] + self.flags["common"]
-        self.cc  = [main_cc]
-        self.cppc =[main_cppc]
+        tools = self._resolve_tools(tool_path)
+        self.asm = [tools.cc] + self.flags['asm'] + self.flags["common"]
+        self.cc  = [tools.cc]
+        self.cppc =[tools.cppc]
         self.cc += self.flags['c'] + self.flags['common']
         self.cppc += self.flags['cxx'] + self.flags['common']
 
+        # Optionally run the compilers through ccache
+        if environ.get('MBED_USE_CCACHE') and find_executable('ccache'):
+            # Relative paths and compiler content hashes keep the cache
+            # valid across checkouts and toolchain installations
+            environ.setdefault('CCACHE_BASEDIR', getcwd())
+            environ.setdefault('CCACHE_COMPILERCHECK', 'content')
+            # ccache does not cache sources using a precompiled header
+            # unless it is told to ignore the PCH's defines and time macros
+            if self.enable_pch:
+                environ.setdefault('CCACHE_SLOPPINESS',
+                                   'pch_defines,time_macros')
+            self.asm = ['ccache'] + self.asm
+            self.cc = ['ccache'] + self.cc
+            self.cppc = ['ccache'] + self.cppc
+
+        # The compiler commands are only copied from, never changed in place
+        self.asm = tuple(self.asm)
+        self.cc = tuple(self.cc)
+        self.cppc = tuple(self.cppc)
+
         self.flags['ld'] += self.cpu
-        self.ld = [join(tool_path, "arm-none-eabi-gcc")] + self.flags['ld']
+        # Optionally link with LLD instead of the BFD linker. This needs
+        # GCC 9 or later, and LLD cannot load GCC's LTO plugin
+        if environ.get('MBED_USE_LLD') and not self.lto:
+            self.flags['ld'].append("-fuse-ld=lld")
+        self.ld = [tools.cc] + self.flags['ld']
+        # Let the LTO link share the job slots of an enclosing parallel make.
+        # Only the command is changed, so the build profile stays the same
+        if self.lto and self.jobserver_available():
+            self.ld = ["-flto=jobserver" if f == "-flto" else f
+                       for f in self.ld]
         self.sys_libs = ["stdc++", "supc++", "m", "c", "gcc", "nosys"]
-        self.preproc = [join(tool_path, "arm-none-eabi-cpp"), "-E", "-P"]
-
-        self.ar = join(tool_path, "arm-none-eabi-ar")
-        self.elf2bin = join(tool_path, "arm-none-eabi-objcopy")
+        self.preproc = [tools.cpp, "-E", "-P"]
+
+        # gcc-ar loads the LTO plugin, so the archive index covers LTO objects
+        self.ar = tools.ar
+        self.elf2bin = tools.objcopy
+
+        # Compile options are identical for most of the translation units of
+        # a build, so they are generated once per unique set of arguments.
+        # See get_compile_options()
+        self._copt_cache = {}
+
+    @classmethod
+    def _resolve_tools(cls, tool_path):
+        """Return the locations of the GCC executables within tool_path.
+        The result is computed once per toolchain path and then reused."""
+        if tool_path not in cls._TOOL_CACHE:
+            cls._TOOL_CACHE[tool_path] = GCCTools(
+                cc=join(tool_path, "arm-none-eabi-gcc"),
+                cppc=join(tool_path, "arm-none-eabi-g++"),
+                ar=join(tool_path, "arm-none-eabi-gcc-ar"),
+                objcopy=join(tool_path, "arm-none-eabi-objcopy"),
+                cpp=join(tool_path, "arm-none-eabi-cpp"))
+        return cls._TOOL_CACHE[tool_path]
 
     def is_not_supported_error(self, output):
         return "error: #error [NOT_SUPPORTED]" in output
 
     def parse_output(self, output):
-        # The warning/error notification is multiline
+        # The warning/error notification is multiline: everything between two
+        # diagnostics belongs to the text of the first one
         msg = None
-        for line in output.splitlines():
-            match = self.DIAGNOSTIC_PATTERN.search(line)
-            if match is not None:
-                if msg is not None:
-                    self.cc_info(msg)
-                    msg = None
-                msg = {
-                    'severity': match.group('severity').lower(),
-                    'file': match.group('file'),
-                    'line': match.group('line'),
-                    'col': 0,
-                    'message': match.group('message'),
-                    'text': '',
-                    'target_name': self.target.name,
-                    'toolchain_name': self.name
-                }
-            elif msg is not None:
-                # Determine the warning/error column by calculating the ^ position
-                match = self.INDEX_PATTERN.match(line)
-                if match is not None:
-                    msg['col'] = len(match.group('col'))
-                    self.cc_info(msg)
-                    msg = None
-                else:
-                    msg['text'] += line+"\n"
+        prev_end = 0
+        for match in self.DIAGNOSTIC_PATTERN.finditer(output):
+            if msg is not None:
+                msg['text'] = output[prev_end:match.start()].strip("\r\n")
+                self.cc_info(msg)
+            msg = {
+                'severity': match.group('severity').lower(),
+                'file': match.group('file'),
+                'line': match.group('line'),
+                'col': int(match.group('col') or 0),
+                'message': match.group('message'),
+                'text': '',
+                'target_name': self.target.name,
+                'toolchain_name': self.name
+            }
+            prev_end = match.end()
 
         if msg is not None:
+            msg['text'] = output[prev_end:].strip("\r\n")
             self.cc_info(msg)
 
     def get_dep_option(self, object):
         base, _ = splitext(object)
         dep_path = base + '.d'
-        return ["-MD", "-MF", dep_path]
+        return ["-MMD", "-MP", "-MF", dep_path]
 
     def get_config_option(self, config_header):
         return ['-include', config_header]
 
+    def build_pch(self, header):
+        """Precompile the configuration header into header.gch. GCC picks up
+        the precompiled header automatically when a C++ source includes the
+        header, so the configuration is not parsed again for every source."""
+        pch = header + ".gch"
+        deps = [header, join(self.build_dir, self.PROFILE_FILE_NAME + "-cxx")]
+        if self.need_update(pch, deps):
+            cmd = list(self.cppc)
+            cmd.extend('-D%s' % d for d in self.get_symbols())
+            cmd.extend(("-x", "c++-header", header, "-o", pch))
+            self.cc_verbose("Precompile: %s" % ' '.join(cmd))
+            self.default_cmd(cmd)
+        return pch
+
     def get_compile_options(self, defines, includes, for_asm=False):
+        config_header = None if for_asm else self.get_config_header()
+        key = (tuple(defines), tuple(includes), for_asm, config_header)
+        if key in self._copt_cache:
+            return self._copt_cache[key]
+
         opts = ['-D%s' % d for d in defines]
         if self.RESPONSE_FILES:
             opts += ['@%s' % self.get_inc_file(includes)]
         else:
             opts += ["-I%s" % i for i in includes]
 
-        if not for_asm:
-            config_header = self.get_config_header()
-            if config_header is not None:
-                opts = opts + self.get_config_option(config_header)
+        if config_header is not None:
+            if self.enable_pch:
+                self.build_pch(config_header)
+            opts = opts + self.get_config_option(config_header)
+
+        self._copt_cache[key] = opts
         return opts
 
     @hook_tool
     def assemble(self, source, object, includes):
         # Build assemble command
-        cmd = self.asm + self.get_compile_options(self.get_symbols(True), includes) + ["-o", object, source]
+        cmd = list(self.asm)
+        cmd.extend(self.get_compile_options(self.get_symbols(True), includes))
+        cmd.extend(("-o", object, source))
 
         # Call cmdline hook
         cmd = self.hook.get_cmdline_assembler(cmd)
@@ -182,11 +275,12 @@ class GCC(mbedToolchain):
     @hook_tool
     def compile(self, cc, source, object, includes):
         # Build compile command
-        cmd = cc + self.get_compile_options(self.get_symbols(), includes)
+        cmd = list(cc)
+        cmd.extend(self.get_compile_options(self.get_symbols(), includes))
 
         cmd.extend(self.get_dep_option(object))
 
-        cmd.extend(["-o", object, source])
+        cmd.extend(("-o", object, source))
 
         # Call cmdline hook
         cmd = self.hook.get_cmdline_compiler(cmd)
@@ -201,19 +295,22 @@ class GCC(mbedToolchain):
 
     @hook_tool
     def link(self, output, objects, libraries, lib_dirs, mem_map):
-        libs = []
-        for l in libraries:
-            name, _ = splitext(basename(l))
-            libs.append("-l%s" % name[3:])
-        libs.extend(["-l%s" % l for l in self.sys_libs])
+        libs = (["-l%s" % splitext(basename(l))[0][3:] for l in libraries] +
+                ["-l%s" % l for l in self.sys_libs])
 
-        # Preprocess
+        # Preprocess, unless the previous output is still up to date. The
+        # output is named after its source, so that switching to another
+        # linker script never reuses the output of the previous one
         if mem_map:
-            preproc_output = join(dirname(output), ".link_script.ld")
-            cmd = (self.preproc + [mem_map] + self.ld[1:] +
-                   [ "-o", preproc_output])
-            self.cc_verbose("Preproc: %s" % ' '.join(cmd))
-            self.default_cmd(cmd)
+            preproc_output = join(dirname(output), ".link_script_%s.ld" %
+                                  md5(abspath(mem_map)).hexdigest())
+            deps = [mem_map,
+                    join(self.build_dir, self.PROFILE_FILE_NAME + "-ld")]
+            if self.need_update(preproc_output, deps):
+                cmd = (self.preproc + [mem_map] + self.ld[1:] +
+                       [ "-o", preproc_output])
+                self.cc_verbose("Preproc: %s" % ' '.join(cmd))
+                self.default_cmd(cmd)
             mem_map = preproc_output
 
         # Build linker command
@@ -224,7 +321,6 @@ class GCC(mbedToolchain):
 
         for L in lib_dirs:
             cmd.extend(['-L', L])
-        cmd.extend(libs)
 
         # Call cmdline hook
         cmd = self.hook.get_cmdline_linker(cmd)
@@ -253,7 +349,11 @@ class GCC(mbedToolchain):
     def binary(self, resources, elf, bin):
         # Build binary command
         _, fmt = splitext(bin)
-        bin_arg = {'.bin': 'binary', '.hex': 'ihex'}[fmt]
+        bin_arg = self._BIN_FMT[fmt]
+        if bin_arg is None:
+            if abspath(elf) != abspath(bin):
+                copyfile(elf, bin)
+            return
         cmd = [self.elf2bin, "-O", bin_arg, elf, bin]
 
         # Call cmdline hook
@@ -280,15 +380,7 @@ class GCC(mbedToolchain):
         """Returns True if the executable (arm-none-eabi-gcc) location
         specified by the user exists OR the executable can be found on the PATH.
         Returns False otherwise."""
-        if not TOOLCHAIN_PATHS['GCC_ARM'] or not exists(TOOLCHAIN_PATHS['GCC_ARM']):
-            if find_executable('arm-none-eabi-gcc'):
-                TOOLCHAIN_PATHS['GCC_ARM'] = ''
-                return True
-            else:
-                return False
-        else:
-            exec_name = join(TOOLCHAIN_PATHS['GCC_ARM'], 'arm-none-eabi-gcc')
-            return exists(exec_name) or exists(exec_name + '.exe')
+        return _check_gcc_executable(TOOLCHAIN_PATHS['GCC_ARM'])
 
 class GCC_ARM(GCC):
     pass